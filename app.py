@@ -1,5 +1,13 @@
+import glob
+import itertools
+import os
 import re
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
 
 # ======================================================
@@ -20,6 +28,16 @@ if "active_hadith" not in st.session_state:
 if "similar_results" not in st.session_state:
     st.session_state.similar_results = None
 
+# نتائج البحث تُحفظ (مواضع الصفوف) لتبقى بعد إعادة التشغيل عند الاختيار أو "المزيد"
+if "search_hits" not in st.session_state:
+    st.session_state.search_hits = None
+
+if "search_fuzzy" not in st.session_state:
+    st.session_state.search_fuzzy = False
+
+if "results_shown" not in st.session_state:
+    st.session_state.results_shown = 0
+
 
 def go(page):
     st.session_state.page = page
@@ -42,62 +60,90 @@ def route():
 # ======================================================
 # NORMALIZATION
 # ======================================================
-AR_DIACRITICS = re.compile(r"[\u0617-\u061A\u064B-\u0652\u0670\u06D6-\u06ED]")
-
+# يشمل U+0653–U+0655 (المد والهمزة فوق/تحت) التي يفصلها NFKD عن الألف والواو والياء
+AR_DIACRITICS = re.compile(r"[\u0617-\u061A\u064B-\u0655\u0670\u06D6-\u06ED]")
+# أي تتابع من المسافات وعلامات الترقيم غير العربية يصبح مسافة واحدة
+# (نطاقات صريحة بدل \w لأنها أسرع بكثير على النص العربي)
+_SEP_RE = re.compile(r"[^0-9A-Za-z_\u0600-\u06FF]+")
+
+# ذاكرة للاستعلامات والنص المرجعي فقط؛ تمرير المدونة كاملة في load_data يستدعي
+# normalize_ar.__wrapped__ مباشرة حتى لا يطرد إدخالات الاستعلامات.
+# الذاكرة خاصة بعملية الخادم وتشترك فيها كل الجلسات وإعادات التشغيل.
+@lru_cache(maxsize=4096)
 def normalize_ar(text):
-    if not text:
+    # الخلايا الفارغة تصل NaN من Excel و pd.NA من Parquet/feather، ولا يصح اختبار pd.NA بـ not
+    if text is None or pd.isna(text) or not text:
         return ""
-    text = AR_DIACRITICS.sub("", str(text))
-    text = text.replace("أ", "ا").replace("إ", "ا").replace("آ", "ا")
+    text = unicodedata.normalize("NFKD", str(text))
+    text = AR_DIACRITICS.sub("", text)
     text = text.replace("ى", "ي").replace("ة", "ه")
-    text = re.sub(r"[^\w\s\u0600-\u06FF]", " ", text)
-    return re.sub(r"\s+", " ", text).strip()
+    return _SEP_RE.sub(" ", text).strip()
 
+# frozenset: البحث يعمل على مجموعة الكلمات، وتكرار الكلمة في الاستعلام لا يغيّر النتيجة
+@lru_cache(maxsize=4096)
 def tokenize_ar(text):
-    return normalize_ar(text).split()
+    return frozenset(normalize_ar(text).split())
 
 # ======================================================
 # ISNAD
 # ======================================================
-def normalize_isnad(isnad):
-    if not isnad or pd.isna(isnad):
-        return None
-    isnad = normalize_ar(isnad)
-    for w in ["حدثنا", "اخبرنا", "قال", "سمعت", "عن"]:
-        isnad = isnad.replace(w, "")
-    isnad = re.sub(r"\s+", " ", isnad)
-    return isnad.strip()
+ISNAD_STOPWORDS = ["حدثنا", "اخبرنا", "قال", "سمعت", "عن"]
+_ISNAD_STOP = re.compile("|".join(map(re.escape, ISNAD_STOPWORDS)))
+
+def strip_isnad(text_norm):
+    # يعمل على نص مطبّع مسبقًا (matn_norm) فلا يُعاد تطبيعه
+    return " ".join(_ISNAD_STOP.sub("", text_norm).split())
 
 # ======================================================
 # STRICT CORE MATCH (ONLY FOR ANALYSIS)
 # ======================================================
-def contains_core(reference, candidate):
-    ref_tokens = tokenize_ar(reference)
-    cand_tokens = tokenize_ar(candidate)
-    if not ref_tokens:
-        return False
-    shared = sum(1 for t in ref_tokens if t in cand_tokens)
-    if len(ref_tokens) <= 4:
-        return shared >= len(ref_tokens) - 1
-    return (shared / len(ref_tokens)) >= 0.8
+def core_match(shared, n, thresh=0.8):
+    # shared: عدد الكلمات المشتركة (رقم أو مصفوفة numpy)، n: عدد كلمات المرجع
+    if n <= 4:
+        return shared >= n - 1
+    return shared / n >= thresh
+
+# مصفوفة مواضع فارغة مشتركة (للقراءة فقط)
+EMPTY_IDS = np.empty(0, dtype=np.int32)
+
+def similar_rows(index, ref_tokens, n_rows, thresh=0.8):
+    # ref_tokens قائمة بكلمات المرجع مع التكرار: الكلمة المكررة (حدثنا، قال، عن...)
+    # تُحسب بعدد مرات ورودها، و n هو عدد الكلمات كاملًا كما في المطابقة الأصلية
+    n = len(ref_tokens)
+    if n == 0:
+        return EMPTY_IDS
+    counts = Counter(t for t in ref_tokens if t in index)
+    postings = [index[t] for t in counts]
+    # عدد الكلمات المشتركة لكل صف = مجموع تكرار كلمات المرجع التي تظهر فيه
+    weights = np.repeat(list(counts.values()), [len(ids) for ids in postings])
+    shared = np.bincount(
+        np.concatenate([EMPTY_IDS, *postings]), weights=weights, minlength=n_rows
+    )
+    return np.flatnonzero(core_match(shared, n, thresh))
 
 # ======================================================
 # DATA
 # ======================================================
 
-@st.cache_data
-def load_data():
-    import glob
-    import os
+NORM_CACHE = "data/_normalized.feather"
 
-    files = glob.glob("data/*_raw.xlsx")
-    dfs = []
+def find_books():
+    # لكل كتاب نأخذ الأحدث بين ملف Excel ونسخة Parquet (convert_data.py)
+    books = {}
+    for f in glob.glob("data/*_raw.xlsx") + glob.glob("data/*_raw.parquet"):
+        name = os.path.basename(f).rsplit("_raw.", 1)[0]
+        if name not in books or os.path.getmtime(f) >= os.path.getmtime(books[name]):
+            books[name] = f
+    return books
 
-    for f in files:
-        df = pd.read_excel(f)
+def read_books(books):
+    dfs = []
 
-        # اسم الكتاب من الملف
-        book_name = os.path.basename(f).replace("_raw.xlsx", "")
+    for book_name, f in sorted(books.items()):
+        if f.endswith(".parquet"):
+            df = pd.read_parquet(f, dtype_backend="pyarrow")
+        else:
+            df = pd.read_excel(f)
 
         df["source"] = book_name
         df["source_file"] = os.path.basename(f)
@@ -113,8 +159,9 @@ def load_data():
         "raw_text": "matn"
     })
 
-    df_all["matn_norm"] = df_all["matn"].apply(normalize_ar)
-    df_all["isnad_norm"] = df_all["matn"].apply(normalize_isnad)
+    df_all["matn_norm"] = df_all["matn"].apply(normalize_ar.__wrapped__)
+    has_text = df_all["matn"].notna() & (df_all["matn"].astype(str) != "")
+    df_all["isnad_norm"] = df_all["matn_norm"].map(strip_isnad).where(has_text, None)
 
     # مفتاح مؤقت (سيتغير لاحقًا)
     df_all["hadith_key"] = (
@@ -124,42 +171,146 @@ def load_data():
 
     return df_all
 
+def read_norm_cache(books):
+    # النسخة المطبّعة صالحة ما دامت أحدث من ملفات الكتب ومن app.py (حيث قواعد التطبيع)
+    if not os.path.exists(NORM_CACHE):
+        return None
+    deps = list(books.values()) + [__file__]
+    if os.path.getmtime(NORM_CACHE) < max(os.path.getmtime(f) for f in deps):
+        return None
+    try:
+        df_all = pd.read_feather(NORM_CACHE, dtype_backend="pyarrow")
+    except (OSError, ValueError, pa.ArrowException):
+        # ملف تالف أو مقطوع: نعيد البناء من الكتب فيُكتب من جديد
+        return None
+    if set(df_all["source_file"]) != {os.path.basename(f) for f in books.values()}:
+        return None
+    return df_all
+
+# cache_resource: نسخة واحدة مشتركة للقراءة فقط بدل فك pickle للإطار كاملًا في كل إعادة تشغيل
+@st.cache_resource
+def load_data():
+    books = find_books()
+
+    df_all = read_norm_cache(books)
+    if df_all is None:
+        df_all = read_books(books)
+        # الكتابة في ملف مؤقت ثم os.replace حتى لا يبقى ملف مقطوع إن توقفت الكتابة
+        tmp = f"{NORM_CACHE}.{os.getpid()}.tmp"
+        try:
+            df_all.to_feather(tmp)
+            os.replace(tmp, NORM_CACHE)
+        except (OSError, ValueError, pa.ArrowException):
+            # مجلد للقراءة فقط، أو عمود بأنواع مختلطة (مثل رقم "4a") لا يحوّله Arrow
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        else:
+            # نعيد قراءة ما كُتب حتى يكون الإطار (وأنواع أعمدته) في أول تشغيل مطابقًا لما بعده
+            cached = read_norm_cache(books)
+            if cached is not None:
+                df_all = cached
+
+    return df_all
+
+# ======================================================
+# INVERTED INDEX (token -> row positions)
+# ======================================================
+@st.cache_resource
+def build_index(_df):
+    postings = {}
+    for i, text in enumerate(_df["matn_norm"]):
+        for t in set(text.split()):
+            postings.setdefault(t, []).append(i)
+    return {t: np.asarray(ids, dtype=np.int32) for t, ids in postings.items()}
+
+@st.cache_resource
+def build_key_index(_df):
+    # hadith_key -> مواضع الصفوف، بدل مقارنة العمود كاملًا في كل إعادة تشغيل
+    return _df.groupby("hadith_key").indices
+
+def token_mask(index, tok, n_rows):
+    # البحث جزئي داخل الكلمة: نجمع كل كلمات المعجم التي تحتوي التوكن
+    mask = np.zeros(n_rows, dtype=bool)
+    for t, ids in index.items():
+        if tok in t:
+            mask[ids] = True
+    return mask
+
+def search_and(index, tokens, n_rows):
+    masks = [token_mask(index, tok, n_rows) for tok in tokens]
+    return np.flatnonzero(np.logical_and.reduce(masks))
+
+# ======================================================
+# FUZZY FALLBACK (edit distance over the vocabulary)
+# ======================================================
+FUZZY_MIN_LEN = 3
+FUZZY_MAX_DIST = 1
+
+def fuzzy_token_mask(index, tok, n_rows):
+    # rapidfuzz يُستورد هنا فقط: هذا المسار لا يعمل إلا عند غياب المطابقة الحرفية
+    from rapidfuzz import process
+    from rapidfuzz.distance import Levenshtein
+
+    mask = token_mask(index, tok, n_rows)
+    # الكلمات القصيرة جدًا يقابلها عدد كبير من الكلمات على مسافة حرف واحد
+    if len(tok) < FUZZY_MIN_LEN:
+        return mask
+    close = process.extract(
+        tok, list(index),
+        scorer=Levenshtein.distance,
+        score_cutoff=FUZZY_MAX_DIST,
+        limit=None
+    )
+    for word, _, _ in close:
+        mask[index[word]] = True
+    return mask
+
+def search_fuzzy(index, tokens, n_rows):
+    masks = [fuzzy_token_mask(index, tok, n_rows) for tok in tokens]
+    return np.flatnonzero(np.logical_and.reduce(masks))
+
 # ======================================================
 # VISUAL BAR (NON INTERACTIVE)
 # ======================================================
+BAR_COLORS = [
+    "#d73027", "#f46d43", "#fdae61", "#fee08b",
+    "#ffffbf", "#d9ef8b", "#a6d96a", "#66bd63",
+    "#1a9850", "#006837"
+]
+
+def _bar_cell(color, opacity):
+    return (
+        f'<div style="width:24px;height:14px;background:{color};'
+        f'opacity:{opacity};display:inline-block;margin:2px;'
+        f'border-radius:4px;"></div>'
+    )
+
+# الخلايا العشر تُبنى مرة واحدة: نسخة مفعّلة ونسخة باهتة لكل لون
+_BAR_ON = [_bar_cell(c, "1") for c in BAR_COLORS]
+_BAR_OFF = [_bar_cell(c, "0.25") for c in BAR_COLORS]
+
 def render_bar(score):
-    colors = [
-        "#d73027", "#f46d43", "#fdae61", "#fee08b",
-        "#ffffbf", "#d9ef8b", "#a6d96a", "#66bd63",
-        "#1a9850", "#006837"
-    ]
-    active = int(round(score)) - 1
-    html = ""
-    for i, c in enumerate(colors):
-        opacity = "1" if i <= active else "0.25"
-        html += f"""
-        <div style="
-            width:24px;
-            height:14px;
-            background:{c};
-            opacity:{opacity};
-            display:inline-block;
-            margin:2px;
-            border-radius:4px;">
-        </div>
-        """
+    active = int(round(score))
+    html = "".join(_BAR_ON[:active] + _BAR_OFF[active:])
     st.markdown(html, unsafe_allow_html=True)
 
 # ======================================================
 # PAGE 1 — SEARCH
 # ======================================================
+RESULTS_PAGE_SIZE = 20
+
 def page_search():
     st.title("🔍 البحث عن الحديث")
     st.write("بحث لغوي عام: أدخل كلمة أو أكثر (يجب أن تجتمع الكلمات معًا).")
 
-    query = st.text_input("نص البحث")
+    # النموذج يؤجل إعادة التشغيل حتى الضغط على "ابحث" (أو Enter)
+    with st.form("search_form"):
+        query = st.text_input("نص البحث")
+        submitted = st.form_submit_button("ابحث", type="primary")
 
-    if st.button("ابحث", type="primary"):
+    if submitted:
         query = query.strip()
 
         if not query:
@@ -175,31 +326,59 @@ def page_search():
         # =========================
         # AND SEARCH (all words)
         # =========================
-        results = df.copy()
-        for tok in tokens:
-            results = results[
-                results["matn_norm"].str.contains(tok, regex=False)
-            ]
-
-        if results.empty:
-            st.warning("❌ لم تُوجد أي أحاديث تحتوي جميع الكلمات معًا")
-            return
+        hits = search_and(index, tokens, len(df))
+        fuzzy = False
 
+        if not len(hits):
+            hits = search_fuzzy(index, tokens, len(df))
+            fuzzy = True
 
-        else:
-            st.success("🔎 تم العثور على نتائج مطابقة للعبارة كاملة")
+        st.session_state.search_hits = hits
+        st.session_state.search_fuzzy = fuzzy
+        st.session_state.results_shown = RESULTS_PAGE_SIZE
 
-        # =========================
-        # عرض النتائج
-        # =========================
-        for key, grp in results.groupby("hadith_key"):
-            with st.expander(f"🧭 حديث: {key}"):
-                st.write(grp.iloc[0]["matn"])
+    hits = st.session_state.search_hits
+    if hits is None:
+        return
+
+    results = df.iloc[hits]
+
+    if results.empty:
+        st.warning("❌ لم تُوجد أي أحاديث تحتوي جميع الكلمات معًا")
+        return
+
+    elif st.session_state.search_fuzzy:
+        st.info("≈ لا توجد مطابقة حرفية؛ هذه نتائج تقريبية (فرق حرف واحد في الكلمة)")
+
+    else:
+        st.success("🔎 تم العثور على نتائج مطابقة للعبارة كاملة")
+
+    # =========================
+    # عرض النتائج (على دفعات)
+    # =========================
+    keys = results["hadith_key"].to_numpy()
+    matns = results["matn"].to_numpy()
+    order = np.argsort(keys, kind="stable")
+    groups = [
+        (key, next(grp))
+        for key, grp in itertools.groupby(order, key=keys.__getitem__)
+    ]
+    shown = st.session_state.results_shown
+
+    for key, first in groups[:shown]:
+        with st.expander(f"🧭 حديث: {key}"):
+            st.write(matns[first])
+
+            if st.button("🧭 اختيار هذا الحديث", key=f"sel_{key}"):
+                st.session_state.active_hadith = key
+                st.session_state.page = "unit"
+                st.rerun()
 
-                if st.button("🧭 اختيار هذا الحديث", key=f"sel_{key}"):
-                    st.session_state.active_hadith = key
-                    st.session_state.page = "unit"
-                    st.rerun()
+    if len(groups) > shown:
+        st.caption(f"عُرض {shown} من {len(groups)} حديثًا")
+        if st.button("المزيد"):
+            st.session_state.results_shown += RESULTS_PAGE_SIZE
+            st.rerun()
 
 
 
@@ -208,7 +387,8 @@ def page_search():
 # ======================================================
 def page_unit():
     key = st.session_state.active_hadith
-    data = df[df["hadith_key"] == key]
+    rows = key_index[key]
+    data = df.iloc[rows]
 
     st.title(f"🧭 وحدة الحديث – {key}")
     st.markdown("### 📌 المتن المرجعي")
@@ -219,14 +399,13 @@ def page_unit():
 
     with col1:
         if st.button("🔎 البحث عن المتشابه"):
-            ref = data.iloc[0]["matn"]
-            sim = df[df["matn"].apply(lambda x: contains_core(ref, x))]
-            st.session_state.similar_results = sim
+            ref_tokens = normalize_ar(data.iloc[0]["matn"]).split()
+            st.session_state.similar_results = similar_rows(index, ref_tokens, len(df))
             go("analysis")
 
     with col2:
         if st.button("📊 الانتقال إلى التحقيق"):
-            st.session_state.similar_results = data
+            st.session_state.similar_results = rows
             go("analysis")
 
     st.markdown("---")
@@ -237,23 +416,27 @@ def page_unit():
 # PAGE 3 — ANALYSIS
 # ======================================================
 def page_analysis():
-    data = st.session_state.similar_results
+    # الجلسة تحفظ مواضع الصفوف فقط، لا نسخة من الإطار
+    data = df.iloc[st.session_state.similar_results]
 
     st.title("🔬 التحقيق الحديثي والمتشابه")
 
     scores = []
 
-    for isnad, grp in data.groupby("isnad_norm"):
-        st.markdown(f"**السند:** {isnad}")
-        score = st.selectbox(
-            "درجة الطريق (0–10)",
-            list(range(11)),
-            index=7,
-            key=f"s_{isnad}"
-        )
-        render_bar(score)
-        scores.append(score)
-        st.markdown("---")
+    # تعديل الدرجات داخل نموذج: إعادة تشغيل واحدة عند "احسب" بدل واحدة لكل اختيار
+    with st.form("isnad_form"):
+        for isnad in sorted(data["isnad_norm"].dropna().unique()):
+            st.markdown(f"**السند:** {isnad}")
+            score = st.selectbox(
+                "درجة الطريق (0–10)",
+                list(range(11)),
+                index=7,
+                key=f"s_{isnad}"
+            )
+            render_bar(score)
+            scores.append(score)
+            st.markdown("---")
+        st.form_submit_button("احسب")
 
     if scores:
         final = round(sum(scores) / len(scores), 1)
@@ -267,4 +450,7 @@ def page_analysis():
 # ======================================================
 # RUN APP
 # ======================================================
+df = load_data()
+index = build_index(df)
+key_index = build_key_index(df)
 route()
\ No newline at end of file
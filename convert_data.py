@@ -0,0 +1,12 @@
+import glob
+
+import pandas as pd
+
+# ======================================================
+# تحويل data/*_raw.xlsx إلى Parquet
+# (يُشغَّل مرة واحدة بعد كل تحديث لملفات Excel)
+# ======================================================
+for f in sorted(glob.glob("data/*_raw.xlsx")):
+    out = f[:-len(".xlsx")] + ".parquet"
+    pd.read_excel(f).to_parquet(out, compression="zstd", index=False)
+    print(f"{f} -> {out}")